@@ -3,6 +3,7 @@ Implements fully connected networks in PyTorch.
 WARNING: you SHOULD NOT use ".to()" or ".cuda()" in each implementation block.
 """
 import torch
+import torch.nn.functional as F
 import libs
 from libs import Solver
 
@@ -23,13 +24,18 @@ class Linear(object):
         - b: A tensor of biases, of shape (M,)
         Returns a tuple of:
         - out: output, of shape (N, M)
-        - cache: (x, w, b)
+        - cache: (x, x2d, w, b), where x2d is x flattened to shape (N, D)
         """
         out = None
         N = x.size(dim=0)  
-        D = torch.prod(torch.tensor(x.shape[1:])).item()  
-        out = torch.mm(x.reshape(N,D), w) + b 
-        cache = (x, w, b)
+        x2d = x.reshape(N, -1)
+        if x.dtype in (torch.float32, torch.float64):
+            # For 2-D input F.linear lowers to addmm, so the bias is still added
+            # inside the GEMM; w.t() is only a view and w keeps its (D, M) layout.
+            out = F.linear(x2d, w.t(), b)
+        else:
+            out = torch.mm(x2d, w) + b
+        cache = (x, x2d, w, b)
         return out, cache
 
     @staticmethod
@@ -40,6 +46,7 @@ class Linear(object):
         - dout: Upstream derivative, of shape (N, M)
         - cache: Tuple of:
           - x: Input data, of shape (N, d_1, ... d_k)
+          - x2d: Input data flattened to shape (N, D)
           - w: Weights, of shape (D, M)
           - b: Biases, of shape (M,)
         Returns a tuple of:
@@ -48,13 +55,11 @@ class Linear(object):
         - dw: Gradient with respect to w, of shape (D, M)
         - db: Gradient with respect to b, of shape (M,)
         """
-        x, w, b = cache
+        x, x2d, w, b = cache
         dx, dw, db = None, None, None
-        N = x.size(dim=0)  
-        D = torch.prod(torch.tensor(x.shape[1:])).item() 
         dx = torch.mm(dout, w.t()) 
         dx = dx.reshape(x.size())  
-        dw = torch.mm(x.reshape(N,D).t(), dout)  
+        dw = torch.mm(x2d.t(), dout)  
         db = torch.sum(dout, dim=0)  
         return dx, dw, db
 
@@ -73,7 +78,7 @@ class ReLU(object):
         - cache: x
         """
         out = None
-        out = torch.max(x,torch.zeros_like(x))
+        out = torch.relu(x)
         # به ازای مقادیر منفی در اینجا صفر میگذاریم و به ازای مقادیر مثبت خودشان را میگذاریم که همانند کاریست که ReLU انجام میدهد. 
         cache = x
         return out, cache
@@ -91,14 +96,14 @@ class ReLU(object):
         """
         dx, x = None, cache
 # مشتق برابر یک است در جاهایی که ورودی بزرگتر از 0 است.
-        dx = dout * (cache > 0) 
+        dx = dout.masked_fill(x <= 0, 0)
         return dx
 
 
 class Linear_ReLU(object):
 
     @staticmethod
-    def forward(x, w, b):
+    def forward(x, w, b, out=None, mask=None):
         """
         Convenience layer that performs an linear transform
         followed by a ReLU.
@@ -107,17 +112,28 @@ class Linear_ReLU(object):
         Inputs:
         - x: Input to the linear layer
         - w, b: Weights for the linear layer
+        - out, mask: Optional preallocated (N, M) buffers for the output and
+          for the bool ReLU mask. If given, they are overwritten in place.
         Returns a tuple of:
         - out: Output from the ReLU
         - cache: Object to give to the backward pass (hint: cache = (fc_cache, relu_cache))
         """
-        out = None
         cache = None
         N1 = x.size(dim=0) 
-        D1 = torch.prod(torch.tensor(x.shape[1:])).item()  
-        out_linear = torch.mm(x.reshape(N1,D1), w) + b 
-        out = torch.max(out_linear,torch.zeros_like(out_linear))
-        cache = (x,w,b,out_linear)
+        x2d = x.reshape(N1, -1)
+        if (out is None) != (mask is None):
+            raise ValueError('out and mask buffers must be passed together')
+        # F.linear has no out= argument, so the linear output goes through
+        # addmm / mm directly; with out=None these allocate as usual.
+        if x.dtype in (torch.float32, torch.float64):
+            out_linear = torch.addmm(b, x2d, w, out=out)
+        else:
+            out_linear = torch.mm(x2d, w, out=out).add_(b)
+        # keep only a bool mask of the units ReLU zeroed (1 byte/elem) for backward;
+        # out_linear is either fresh or the caller's buffer, so ReLU runs in place.
+        relu_off = torch.le(out_linear, 0, out=mask)
+        out = torch.relu_(out_linear)
+        cache = (x,x2d,w,b,relu_off)
         return out, cache
 
     @staticmethod
@@ -130,13 +146,11 @@ class Linear_ReLU(object):
         Backward pass for the linear-relu convenience layer
         """
         dx, dw, db = None, None, None
-        x,w,b,out_linear = cache
-        N = x.size(dim=0) 
-        D = torch.prod(torch.tensor(x.shape[1:])).item() 
-        d_relu = dout * (out_linear > 0) 
+        x,x2d,w,b,relu_off = cache
+        d_relu = dout.masked_fill(relu_off, 0)
         dx = torch.mm(d_relu, w.t())
         dx = dx.reshape(x.size())
-        dw = torch.mm(x.reshape(N,D).t(), d_relu)
+        dw = torch.mm(x2d.t(), d_relu)
         db = torch.sum(d_relu, dim=0)
         return dx, dw, db
 
@@ -156,15 +170,20 @@ def softmax_loss(x, y):
     """
     loss = None
     dx = None
-    # اینجا خروجی نسبت به ورودی که ما دادیم تولید میشود.این خروجی نسبت به مجموع احتمال کلاس ها نرمالزه شده است و بین 0و1 قرار میگیرد. . 
-    f = torch.exp(x)/ torch.sum(torch.exp(x), axis=1, keepdims=True)
     N = x.size(dim=0)
-    # در اینجا با اندیس کلاس درست، احتمال های سافتمکس محاسبه میشود . بر روی آنها میانگین گیری انجام میشود تا مشخص شود که نمرات هر کلاس چه قدر با برچسب واقعی مشابهت دارند. 
-    loss = -torch.sum(torch.log(f[torch.arange(N),y])) / N
-    dx =f  
+    in_dtype = x.dtype
+    # Half-precision scores are upcast so the softmax itself runs in float32.
+    if in_dtype in (torch.float16, torch.bfloat16):
+        x = x.float()
+    # log_softmax subtracts the row max before exponentiating, so large scores
+    # do not overflow and exp is evaluated only once.
+    log_probs = F.log_softmax(x, dim=1)
+    loss = F.nll_loss(log_probs, y)
+    dx = torch.exp(log_probs)
     # با قاعده ی زنجیره ای مشتق حساب می شود. 
-    dx[torch.arange(N),y] -= 1  
-    dx /= N 
+    dx.scatter_add_(1, y.view(N, 1), dx.new_full((N, 1), -1))
+    dx /= N
+    dx = dx.to(in_dtype)
     return loss, dx
 
 
@@ -250,20 +269,18 @@ class TwoLayerNet(object):
         scores = None
          
         Lrelu_out1 , cache1 = Linear_ReLU.forward(X,self.params['W1'],self.params['b1'])
-        x1,self.params['W1'],self.params['b1'],out_linear1 = cache1
         linear_out2 , cache2 = Linear.forward(Lrelu_out1,self.params['W2'],self.params['b2'])
-        x2,self.params['W2'],self.params['b2'] = cache2
-        # در اینجا نمرات مثل خروجی لایه ی سافتمکس تعیین میشوند که برای حالت تست خواهد بود که وارد فاز آموزش نشویم و گرادیان ها را آپدیت نکنیم. . 
-        scores = torch.exp(linear_out2)/ torch.sum(torch.exp(linear_out2), axis=1, keepdims=True)
-        
 
-        
         if y is None:
+            # در اینجا نمرات مثل خروجی لایه ی سافتمکس تعیین میشوند که برای حالت تست خواهد بود که وارد فاز آموزش نشویم و گرادیان ها را آپدیت نکنیم. . 
+            scores = F.softmax(linear_out2, dim=1)
             return scores
         
         loss, grads = 0, {}
         loss,ds = softmax_loss(linear_out2,y)
-        loss += self.reg * (torch.sum(self.params['W1'] * self.params['W1']) + torch.sum(self.params['W2'] * self.params['W2'])) 
+        if self.reg != 0:
+            Ws = [self.params['W1'], self.params['W2']]
+            loss += self.reg * torch.stack(torch._foreach_norm(Ws, 2)).square().sum()
         dLrelu_out1,dw2,db2 = Linear.backward(ds,cache2)
         dx,dw1,db1 = Linear_ReLU.backward(dLrelu_out1,cache1)
         grads['W1'] = dw1
@@ -275,6 +292,32 @@ class TwoLayerNet(object):
         
         
       
+def _fc_forward(X, Ws, bs, use_dropout, dropout_param, buffers=None):
+    """
+    Forward pass of FullyConnectedNet, kept as a free function so that it can
+    be wrapped with torch.compile. Ws and bs are lists holding the weights and
+    biases of layers 1, ..., L, and buffers optionally holds an (act, mask) pair
+    of preallocated buffers for each hidden layer. Returns a tuple
+    (scores, cache, cache_drop) where cache and cache_drop hold the per-layer
+    caches for the backward pass.
+    """
+    num_layers = len(Ws)
+    scores = None
+    out = [None] * (num_layers + 1) # یک لیست برای خروجی های هر لایه تعریف میکنیم که تنسورهای خروجی هر لایه را در خود جا میدهید و با هر لایه جلو میرود
+    out[0] = X  # ورودی را به عنوان اولین المنت از لیست خروجی میدهیم تا در حلقه ای که مینویسیم برای لایه ی اول، آرگومان ها درست باشند. 
+    cache = [None] * (num_layers + 1) # این برای عملیات پس انتشار تعریف میشود که هر لایه ی خورجی باید آنرا داشته باشد. 
+    cache_drop = [None] * (num_layers + 1) # این هم برای عملیات پس انتشار برای دراپ اوت تعریف میکنیم که با هر لایه دراپ اوت، عضو جدیدی میگیرد.. 
+    for i in range(0,num_layers-1):
+        act, mask = buffers[i] if buffers is not None else (None, None)
+        out[i+1] , cache[i+1] = Linear_ReLU.forward(out[i],Ws[i],bs[i],act,mask)
+        if use_dropout:
+            out[i+1] , cache_drop[i+1] = Dropout.forward(out[i+1], dropout_param)
+    scores , cache[num_layers] = Linear.forward(out[num_layers-1],Ws[num_layers-1],bs[num_layers-1])
+    if use_dropout:
+        scores, cache_drop[num_layers] = Dropout.forward(scores, dropout_param)
+    return scores, cache, cache_drop
+
+
 class FullyConnectedNet(object):
     """
     A fully-connected neural network with an arbitrary number of hidden layers,
@@ -291,7 +334,7 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=0.0, reg=0.0, weight_scale=1e-2, seed=None,
-                 dtype=torch.float, device='cpu'):
+                 dtype=torch.float, device='cpu', use_compile=False):
         """
         Initialize a new FullyConnectedNet.
 
@@ -313,6 +356,9 @@ class FullyConnectedNet(object):
           performed using this datatype. float is faster but less accurate,
           so you should use double for numeric gradient checking.
         - device: device to use for computation. 'cpu' or 'cuda'
+        - use_compile: If True, run the forward pass and softmax_loss through
+          torch.compile so the linear, ReLU and dropout ops of all layers and
+          the loss/gradient computation can each be fused.
         """
         self.use_dropout = dropout != 0
         self.reg = reg
@@ -327,6 +373,8 @@ class FullyConnectedNet(object):
         self.params['b1'] = torch.zeros(hidden_dims[0],device=device, dtype=dtype)
         self.params['W' + str(self.num_layers)] = weight_scale * torch.randn(hidden_dims[self.num_layers-2],num_classes,device=device,dtype=dtype )
         self.params['b' + str(self.num_layers)] = torch.zeros(num_classes,device=device, dtype=dtype)
+        self._set_param_keys()
+        self._buffers = {}
         # When using dropout we need to pass a dropout_param dictionary
         # to each dropout layer so that the layer knows the dropout
         # probability and the mode (train / test). You can pass the same
@@ -336,6 +384,38 @@ class FullyConnectedNet(object):
             self.dropout_param = {'mode': 'train', 'p': dropout}
             if seed is not None:
                 self.dropout_param['seed'] = seed
+        # Shapes are fixed for a given batch size, so compile statically.
+        self._forward = _fc_forward
+        self._softmax_loss = softmax_loss
+        if use_compile:
+            self._forward = torch.compile(_fc_forward, dynamic=False)
+            self._softmax_loss = torch.compile(
+                softmax_loss, fullgraph=True, dynamic=False)
+
+    def _set_param_keys(self):
+        # self.params stays the source of truth because the Solver and callers
+        # replace its entries; these keys let loss() gather the tensors into
+        # per-layer lists without rebuilding 'W' + str(i) every minibatch.
+        self._W_keys = ['W' + str(i) for i in range(1, self.num_layers + 1)]
+        self._b_keys = ['b' + str(i) for i in range(1, self.num_layers + 1)]
+
+    def _hidden_buffers(self, N, Ws):
+        # Activation and ReLU-mask buffers of the hidden layers, reused across
+        # training minibatches. Only the buffers for the most recent batch
+        # size are kept; a different shape replaces them. Not used when the
+        # forward is compiled: torch.compile functionalizes out= and in-place
+        # writes to graph inputs and copies the results back, which would add
+        # a copy per layer instead of saving an allocation.
+        buffers = []
+        for i, w in enumerate(Ws[:-1]):
+            act, mask = self._buffers.get(i, (None, None))
+            if (act is None or act.shape != (N, w.size(1))
+                    or act.dtype != w.dtype or act.device != w.device):
+                act = torch.empty(N, w.size(1), dtype=w.dtype, device=w.device)
+                mask = torch.empty(N, w.size(1), dtype=torch.bool, device=w.device)
+                self._buffers[i] = (act, mask)
+            buffers.append((act, mask))
+        return buffers
 
     def save(self, path):
         checkpoint = {
@@ -358,6 +438,8 @@ class FullyConnectedNet(object):
         self.num_layers = checkpoint['num_layers']
         self.use_dropout = checkpoint['use_dropout']
         self.dropout_param = checkpoint['dropout_param']
+        self._set_param_keys()
+        self._buffers = {}
 
         for p in self.params:
             self.params[p] = self.params[p].type(dtype).to(device)
@@ -369,47 +451,53 @@ class FullyConnectedNet(object):
         Compute loss and gradient for the fully-connected net.
         Input / output: Same as TwoLayerNet above.
         """
-        X = X.to(self.dtype)
+        device = self.params[self._W_keys[0]].device
+        if X.dtype != self.dtype or X.device != device:
+            # Only host-to-device copies are safe to issue asynchronously.
+            X = X.to(device=device, dtype=self.dtype,
+                     non_blocking=device.type == 'cuda')
         mode = 'test' if y is None else 'train'
 
         # Set train/test mode for batchnorm params and dropout param
         # since they behave differently during training and testing.
         if self.use_dropout:
             self.dropout_param['mode'] = mode
-        scores = None
-        out = {} # یک لیست برای خروجی های هر لایه تعریف میکنیم که تنسورهای خروجی هر لایه را در خود جا میدهید و با هر لایه جلو میرود
-        out[0] = X  # ورودی را به عنوان اولین المنت از لیست خروجی میدهیم تا در حلقه ای که مینویسیم برای لایه ی اول، آرگومان ها درست باشند. 
-        cache = {} # این برای عملیات پس انتشار تعریف میشود که هر لایه ی خورجی باید آنرا داشته باشد. 
-        cache_drop = {} # این هم برای عملیات پس انتشار برای دراپ اوت تعریف میکنیم که با هر لایه دراپ اوت، عضو جدیدی میگیرد.. 
-        for i in range(0,self.num_layers-1):
-            out[i+1] , cache[i+1] = Linear_ReLU.forward(out[i],self.params['W'+ str(i+1)],self.params['b'+ str(i+1)])
-            if self.use_dropout:
-                out[i+1] , cache_drop[i+1] = Dropout.forward(out[i+1], self.dropout_param)
-        scores , cache[self.num_layers] = Linear.forward(out[self.num_layers-1],self.params['W' + str(self.num_layers)],self.params['b'+ str(self.num_layers)])
-        if self.use_dropout:
-            scores, cache_drop[self.num_layers] = Dropout.forward(scores, self.dropout_param)
-        
+        Ws = [self.params[k] for k in self._W_keys]
+        bs = [self.params[k] for k in self._b_keys]
+        # Test-time forwards allocate normally so that eval batch sizes do not
+        # churn the training buffers.
+        buffers = None
+        if mode == 'train' and self._forward is _fc_forward:
+            buffers = self._hidden_buffers(X.size(dim=0), Ws)
+        scores, cache, cache_drop = self._forward(
+            X, Ws, bs, self.use_dropout, self.dropout_param, buffers)
+
         # If test mode return early
         if mode == 'test':
             return scores
 # با استفاده از کش های هر لایه ی فوروارد ورودی به خروجی و کش های دراپ اوت ها مسیر پس اشنتار را محاسبه میکنیم.
         loss, grads = 0.0, {}
-        dout = {}
-        loss , ds = softmax_loss(scores,y)
+        dout = [None] * (self.num_layers + 2)
+        dWs = [None] * self.num_layers
+        dbs = [None] * self.num_layers
+        loss , ds = self._softmax_loss(scores,y)
         if self.use_dropout:
                 ds = Dropout.backward(ds, cache_drop[self.num_layers])
-        dout[self.num_layers], grads['W'+ str(self.num_layers)],grads['b' + str(self.num_layers)] = Linear.backward(ds,cache[self.num_layers]) 
-        grads['W'+ str(self.num_layers)] = grads['W'+ str(self.num_layers)] + self.reg * grads['W'+ str(self.num_layers)]               
+        dout[self.num_layers], dWs[self.num_layers-1], dbs[self.num_layers-1] = Linear.backward(ds,cache[self.num_layers]) 
         for i in range (self.num_layers-1,1,-1):
             if self.use_dropout:
                 dout[i+1] = Dropout.backward(dout[i+1], cache_drop[i])
-            dout[i],grads['W'+str(i)],grads['b' + str(i)] = Linear_ReLU.backward(dout[i+1],cache[i])
-            grads['W'+ str(i)] = grads['W'+ str(i)] + self.reg * grads['W'+ str(i)]
-            loss += 0.5 * self.reg * torch.sum(self.params['W' + str(i+1)] * self.params['W' + str(i+1)])
+            dout[i], dWs[i-1], dbs[i-1] = Linear_ReLU.backward(dout[i+1],cache[i])
         if self.use_dropout:
             dout[2] = Dropout.backward(dout[2], cache_drop[1])
-        dx,grads['W1'],grads['b1'] = Linear_ReLU.backward(dout[2],cache[1])
-        loss += 0.5 * self.reg * torch.sum(self.params['W1'] * self.params['W1'])
+        dx, dWs[0], dbs[0] = Linear_ReLU.backward(dout[2],cache[1])
+        if self.reg != 0:
+            # L2 term for every weight matrix: dW += reg * W, applied with
+            # multi-tensor kernels instead of one launch per layer.
+            torch._foreach_add_(dWs, Ws, alpha=self.reg)
+            loss += 0.5 * self.reg * torch.stack(torch._foreach_norm(Ws, 2)).square().sum()
+        grads.update(zip(self._W_keys, dWs))
+        grads.update(zip(self._b_keys, dbs))
         return loss, grads  
         
 
@@ -432,6 +520,11 @@ def create_solver_instance(data_dict, dtype, device):
     num_train_samples = None
     num_val_samples = None
     checkpoint_name = None
+    # Move the dataset to the device once so the Solver's per-minibatch
+    # transfers become no-ops. This needs room for the whole dataset on the
+    # device; tensors already there (as the notebook loads them) are left as is.
+    data_dict = {k: v.to(device) if torch.is_tensor(v) else v
+                 for k, v in data_dict.items()}
     
     # Create the Solver instance
     solver = libs.Solver(model, data_dict,
@@ -513,9 +606,9 @@ def sgd_momentum(w, dw, config=None):
     next_w = None
     learning_rate = config['learning_rate']
     momentum = config['momentum']
-    v = momentum * v - learning_rate * dw
+    v.mul_(momentum).add_(dw, alpha=-learning_rate)
     config['velocity'] = v
-    next_w = w + v
+    next_w = w.add_(v)
 
     return next_w, config
 
@@ -543,9 +636,9 @@ def rmsprop(w, dw, config=None):
     decay_rate = config['decay_rate']
     epsilon = config['epsilon']
     cache = config['cache']
-    cache = decay_rate * cache + (1 - decay_rate) * (dw * dw)
+    cache.mul_(decay_rate).addcmul_(dw, dw, value=1 - decay_rate)
     config['cache'] = cache
-    next_w = w - learning_rate * (dw / (torch.sqrt(cache) + epsilon))
+    next_w = w.addcdiv_(dw, cache.sqrt().add_(epsilon), value=-learning_rate)
 
 
 
@@ -585,13 +678,13 @@ def adam(w, dw, config=None):
     t = config['t']
     t = t + 1
     config['t'] = t
-    m = beta1 * m + (1 - beta1) * dw
-    mh = m / (1 - beta1 ** t)
+    m.mul_(beta1).add_(dw, alpha=1 - beta1)
     config['m'] = m
-    v = beta2 * v + (1 - beta2) * (dw ** 2)
-    vh = v / (1 - beta2 ** t)
+    v.mul_(beta2).addcmul_(dw, dw, value=1 - beta2)
     config['v'] = v
-    next_w = w - learning_rate * (mh / (torch.sqrt(vh) + epsilon))
+    # bias corrections are folded into the denominator and the step size
+    denom = v.div(1 - beta2 ** t).sqrt_().add_(epsilon)
+    next_w = w.addcdiv_(m, denom, value=-learning_rate / (1 - beta1 ** t))
     
 
     return next_w, config
@@ -635,9 +728,9 @@ class Dropout(object):
         out = None
         p = 1 - p
         if mode == 'train':
-             random = torch.rand_like(x)
-             mask = (random < p)/p
-             out = mask * x
+             # Scale the mask in place so forward and backward are a single multiply.
+             mask = (torch.rand_like(x) < p).to(x.dtype).div_(p)
+             out = x * mask
         elif mode =='test':
              out = x
         cache = (dropout_param, mask)